@@ -4,10 +4,10 @@ The :mod:`sklearn.Mmani` module implements data embedding techniques.
 
 from .locally_linear import locally_linear_embedding, LocallyLinearEmbedding
 from .spectral_embedding_ import SpectralEmbedding, spectral_embedding
-from .geometry import graph_laplacian, distance_matrix, DistanceMatrix, affinity_matrix
+from .geometry import graph_laplacian, graph_laplacian_batch, distance_matrix, DistanceMatrix, affinity_matrix
 from .rmetric import *
 #from .isomap import Isomap
 #from .mds import MDS
 
 #__all__ = ['locally_linear_embedding', 'LocallyLinearEmbedding', 'Isomap',
-__all__ = ['locally_linear_embedding', 'LocallyLinearEmbedding', 'spectral_embedding', 'SpectralEmbedding', 'graph_laplacian', 'riemann_metric', 'RiemannMetric', 'distance_matrix','DistanceMatrix','affinity_matrix', 'embed_with_rmetric']
+__all__ = ['locally_linear_embedding', 'LocallyLinearEmbedding', 'spectral_embedding', 'SpectralEmbedding', 'graph_laplacian', 'graph_laplacian_batch', 'riemann_metric', 'RiemannMetric', 'distance_matrix','DistanceMatrix','affinity_matrix', 'embed_with_rmetric']
@@ -11,7 +11,7 @@ For performance, this code uses the FLANN libarary to compute
 approximate neighborhoods efficiently. The down side of approximation
 is that (1) the distance matrix (or adjacency matrix) produced is NOT
 GUARANTEED to be symmetric. We also use sparse representations, and
-(2) fl_radius_neighbors_graph returns a sparse matrix called distance_matrix.
+(2) distance_matrix returns a sparse matrix called distance_matrix.
 
 distance_matrix has 0.0 on the diagonal, as it should. Implicitly, the
 missing entries are infinity not 0 for this matrix. But (1) and (2)
@@ -25,17 +25,27 @@ Hence, I adopted the following convention:
    * laplacian does NOT perform symmetrization by default, only if symmetrize=True, and DOES NOT check symmetry
    * these conventions are the same for dense matrices, for consistency
 
-On internal sparse representations: currently the code contains some
-conversions between the coo and csr formats. In the near future I plan
-to clean these and use csr only.
+On internal sparse representations: the code uses the csr format
+throughout. distance_matrix, affinity_matrix and the sparse laplacian
+return csr matrices, and inputs in other formats are converted to csr
+once on entry. fl_radius_neighbors_graph returns the csr arrays
+(indptr, indices, data) themselves; affinity_matrix and graph_laplacian
+also accept such triples.
 
 """
 #Authors: Marina Meila <mmp@stat.washington.edu>
 #         With help from Jake Vanderplas <vanderplas@astro.washington.edu>
 # License: BSD 3 clause
 
+import importlib
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.sparse.csgraph import connected_components as _csgraph_connected_components
 from pyflann import *     # how to import conditionally
 from sklearn.metrics.pairwise import rbf_kernel
 from sklearn.neighbors import radius_neighbors_graph
@@ -44,28 +54,61 @@ from sklearn.neighbors import kneighbors_graph
 
 from sklearn.utils.graph import graph_shortest_path
 
+# Optional accelerators: numba and numexpr are imported on first use, not
+# when this module is imported; without them the numpy/scipy code paths
+# are used instead
+_optional_modules = {}
+_numba_kernels = {}
+
+def _import_optional(name):
+    """ Returns the module name, imported on first call, or None if it is
+    not installed
+    """
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
+
+def _numba_kernel(make_kernel):
+    """ Returns make_kernel(numba), a numba compiled function, built on first
+    call, or None if numba is not installed
+    """
+    if make_kernel not in _numba_kernels:
+        numba = _import_optional('numba')
+        _numba_kernels[make_kernel] = None if numba is None else make_kernel(numba)
+    return _numba_kernels[make_kernel]
+
 ###############################################################################
 # Path and connected component analysis.
 # Code adapted from networkx
 # Code from sklean/graph (shall we keep this here)
-def single_source_shortest_path_length(graph, source, cutoff=None):
+def single_source_shortest_path_length(graph, source, cutoff=None, return_array=False):
     """Return the shortest path length from source to all reachable nodes.
 
     Returns a dictionary of shortest path lengths keyed by target.
 
+    To find the connected components of a graph, use connected_components,
+    not repeated calls of this function.
+
     Parameters
     ----------
-    graph: sparse matrix or 2D array (preferably LIL matrix)
+    graph: sparse matrix or 2D array (preferably CSR matrix)
         Adjacency matrix of the graph
     source : node label
        Starting node for path
     cutoff : integer, optional
         Depth to stop the search - only
         paths of length <= cutoff are returned.
+    return_array : bool, optional
+        If True, return instead an array of length N with the path lengths,
+        np.inf for the nodes not reached. Cheaper than the dictionary if only
+        a reachability mask is needed.
 
     Examples
     --------
-    >>> from sklearn.utils.graph import single_source_shortest_path_length
+    >>> from Mmani.embedding.geometry import single_source_shortest_path_length
     >>> import numpy as np
     >>> graph = np.array([[ 0, 1, 0, 0],
     ...                   [ 1, 0, 1, 0],
@@ -77,29 +120,117 @@ def single_source_shortest_path_length(graph, source, cutoff=None):
     {0: 1, 1: 1, 2: 0, 3: 1, 4: 1, 5: 1}
     """
     if sparse.isspmatrix(graph):
-        graph = graph.tolil()
+        graph = graph.tocsr()
+    else:
+        graph = sparse.csr_matrix(graph)
+    if not 0 <= source < graph.shape[0]:
+        # _bfs_csr does no bounds checking
+        raise ValueError('source %r out of range for a graph of %d nodes' % (source, graph.shape[0]))
+    bfs_csr = _numba_kernel(_make_bfs_csr)
+    if bfs_csr is not None:
+        seen = bfs_csr(graph.indptr, graph.indices, source, -1 if cutoff is None else cutoff, graph.shape[0])
+        dist = seen.astype(np.float64)
+        dist[seen < 0] = np.inf
+    else:
+        dist = dijkstra(graph, directed=True, indices=source, unweighted=True,
+                        limit=np.inf if cutoff is None else cutoff)
+    if return_array:
+        return dist
+    reached = np.where(np.isfinite(dist))[0]
+    return dict(zip(reached.tolist(), dist[reached].astype(int).tolist()))  # return all path lengths as dictionary
+
+def multi_source_shortest_path_length(graph, sources, cutoff=None):
+    """Return the shortest path lengths from each of sources to all nodes.
+
+    The graph is converted to CSR once, and all the searches are done in a
+    single call to scipy.sparse.csgraph.dijkstra, instead of calling
+    single_source_shortest_path_length for each source.
+
+    Parameters
+    ----------
+    graph: sparse matrix or 2D array (preferably CSR matrix)
+        Adjacency matrix of the graph
+    sources : array_like of node labels
+       Starting nodes for the paths
+    cutoff : integer, optional
+        Depth to stop the search - only
+        paths of length <= cutoff are returned.
+
+    Returns
+    -------
+    dist : ndarray, shape (len(sources), N)
+        dist[k, i] is the number of hops from sources[k] to i, np.inf if i
+        is not reached.
+    """
+    if sparse.isspmatrix(graph):
+        graph = graph.tocsr()
+    else:
+        graph = sparse.csr_matrix(graph)
+    return dijkstra(graph, directed=True, indices=np.atleast_1d(sources), unweighted=True,
+                    limit=np.inf if cutoff is None else cutoff)
+
+def connected_components(graph):
+    """Return the connected components of an undirected graph.
+
+    Parameters
+    ----------
+    graph: sparse matrix or 2D array (preferably CSR matrix)
+        Adjacency matrix of the graph, non-zero weight means an edge
+        between the nodes
+
+    Returns
+    -------
+    n_components : int
+        The number of connected components
+    labels : ndarray, shape (N,)
+        labels[i] is the component of node i, from 0 to n_components - 1
+    """
+    if sparse.isspmatrix(graph):
+        graph = graph.tocsr()
     else:
-        graph = sparse.lil_matrix(graph)
-    seen = {}                   # level (number of hops) when seen in BFS
-    level = 0                   # the current level
-    next_level = [source]       # dict of nodes to check at next level
-    while next_level:
-        this_level = next_level     # advance to next level
-        next_level = set()          # and start a new list (fringe)
-        for v in this_level:
-            if v not in seen:
-                seen[v] = level     # set the level of vertex v
-                next_level.update(graph.rows[v])
-        if cutoff is not None and cutoff <= level:
-            break
-        level += 1
-    return seen  # return all path lengths as dictionary
+        graph = sparse.csr_matrix(graph)
+    return _csgraph_connected_components(graph, directed=False, return_labels=True)
+
+def _make_bfs_csr(numba):
+    """ Compiles the BFS kernel _bfs_csr, see _numba_kernel """
+    @numba.njit(cache=True, boundscheck=False)
+    def _bfs_csr(indptr, indices, source, cutoff, n_nodes):
+        """ Two-queue BFS on the CSR arrays (indptr, indices) of a graph.
+
+        Returns seen, an int32 array of length n_nodes, with seen[v] the
+        number of hops from source to v, or -1 if v was not reached. A
+        negative cutoff means no cutoff.
+        """
+        seen = np.full(n_nodes, -1, np.int32)
+        front = np.empty(n_nodes, np.int32)
+        next_front = np.empty(n_nodes, np.int32)
+        seen[source] = 0
+        front[0] = source
+        front_len = 1
+        level = 0
+        while front_len > 0:
+            if 0 <= cutoff <= level:
+                break
+            nf_len = 0
+            for k in range(front_len):
+                v = front[k]
+                for p in range(indptr[v], indptr[v+1]):
+                    u = indices[p]
+                    if seen[u] < 0:
+                        seen[u] = level + 1
+                        next_front[nf_len] = u
+                        nf_len += 1
+            front, next_front = next_front, front
+            front_len = nf_len
+            level += 1
+        return seen
+    return _bfs_csr
 
 
 ###############################################################################
 # Graph laplacian
 # Code adapted from the Matlab function laplacian.m of Dominique Perrault-Joncas
-def graph_laplacian(csgraph, normed='geometric', symmetrize=False, scaling_epps=0., renormalization_exponent=1, return_diag=False, return_lapsym=False):
+def graph_laplacian(csgraph, normed='geometric', symmetrize=False, scaling_epps=0., renormalization_exponent=1, return_diag=False, return_lapsym=False, dtype=None):
     """ Return the Laplacian matrix of an undirected graph.
 
    Computes a consistent estimate of the Laplace-Beltrami operator L
@@ -131,7 +262,8 @@ def graph_laplacian(csgraph, normed='geometric', symmetrize=False, scaling_epps=
               EPPS = scaling_epps**2
            
     csgraph : array_like or sparse matrix, 2 dimensions
-        compressed-sparse graph, with shape (N, N). 
+        compressed-sparse graph, with shape (N, N). Can also be a csr
+        triple (indptr, indices, data), as from fl_radius_neighbors_graph
     normed : string, optional
         if 'renormalized':
             compute renormalized Laplacian of Coifman & Lafon
@@ -159,6 +291,10 @@ def graph_laplacian(csgraph, normed='geometric', symmetrize=False, scaling_epps=
         lapsym, and a row normalization vector w are also returned. Having
         these allows us to compute the laplacian spectral decomposition 
         as a symmetric matrix, which has much better numerical properties. 
+    dtype : numpy floating type, optional
+        if given, the laplacian is computed in this precision, e.g.
+        np.float32 halves memory traffic. Default: the precision of csgraph
+        if it is floating, else np.float64
 
     Returns
     -------
@@ -184,138 +320,190 @@ def graph_laplacian(csgraph, normed='geometric', symmetrize=False, scaling_epps=
     However, it is not recommended to use this function for directed graphs.
     Use directed_laplacian() (NYImplemented) instead
     """
+    if isinstance(csgraph, tuple):
+        csgraph = _csr_from_triple(csgraph)
     if csgraph.ndim != 2 or csgraph.shape[0] != csgraph.shape[1]:
         raise ValueError('csgraph must be a square matrix or array')
 
     normed = normed.lower()
     if normed not in ('unnormalized', 'geometric', 'randomwalk', 'symmetricnormalized','renormalized' ):
         raise ValueError('normed must be one of unnormalized, geometric, randomwalk, symmetricnormalized, renormalized')
-    if (np.issubdtype(csgraph.dtype, np.int) or np.issubdtype(csgraph.dtype, np.uint)):
+    if dtype is not None:
+        csgraph = csgraph.astype(dtype, copy=False)
+    elif (np.issubdtype(csgraph.dtype, np.int) or np.issubdtype(csgraph.dtype, np.uint)):
         csgraph = csgraph.astype(np.float)
 
     if sparse.isspmatrix(csgraph):
         return _laplacian_sparse(csgraph, normed=normed, symmetrize=symmetrize, scaling_epps=scaling_epps, renormalization_exponent=renormalization_exponent, return_diag=return_diag, return_lapsym = return_lapsym)
 
     else:
-        return _laplacian_dense(csgraph, normed=normed, symmetrize=symmetrize, scaling_epps=scaling_epps, renormalization_exponent=renormalization_exponent, return_diag=return_diag)
+        return _laplacian_dense(csgraph, normed=normed, symmetrize=symmetrize, scaling_epps=scaling_epps, renormalization_exponent=renormalization_exponent, return_diag=return_diag, return_lapsym = return_lapsym)
+
+def graph_laplacian_batch(csgraphs, n_jobs=-1, **kwargs):
+    """ Return the laplacians of several graphs, computed in parallel threads.
+
+    Parameters
+    ----------
+    csgraphs : iterable of array_like or sparse matrices
+        the graphs, each one as for graph_laplacian
+    n_jobs : int, optional
+        number of threads, -1 means as many as CPUs
+    kwargs : 
+        passed to graph_laplacian (normed, symmetrize, scaling_epps, ...)
+
+    Returns
+    -------
+    list of the graph_laplacian results, in the order of csgraphs
+
+    Notes
+    -----
+    The work is done in numpy/scipy C code that releases the GIL, so
+    threads are used, which avoids copying the graphs to worker processes.
+    When numpy uses a multithreaded BLAS, set OMP_NUM_THREADS=1 (or the
+    variable of your BLAS) to avoid oversubscribing the CPUs.
+    """
+    from joblib import Parallel, delayed
+    return Parallel(n_jobs=n_jobs, prefer='threads')(delayed(graph_laplacian)(csgraph, **kwargs) for csgraph in csgraphs)
 
 def _laplacian_sparse(csgraph, normed='geometric', symmetrize=True, scaling_epps=0., renormalization_exponent=1, return_diag=False, return_lapsym = False):
     n_nodes = csgraph.shape[0]
-    if not csgraph.format == 'coo':
-        lap = csgraph.tocoo()
-    else:
-        lap = csgraph.copy()
-#    print( lap.getformat())
     if symmetrize:
-        lapt = lap.copy()
-        dum = lapt.row
-        lapt.row = lapt.col
-        lapt.col = dum
-#        print( 'lapt', lapt.getformat())
-        lap = lap + lapt # coo is converted to csr here
-#        print( lap.getformat())
-        lap.data /= 2.
-    lap = lap.tocoo()
-    diag_mask = (lap.row == lap.col)  # True/False
-
-    degrees = np.asarray(lap.sum(axis=1)).squeeze()
+        lap = symmetrize_sparse(csgraph)    # always a new csr matrix
+    else:
+        lap = csgraph.tocsr(copy=True)
+
+    degrees = _row_sum_csr(lap)
+    w_zeros = (degrees == 0)      # same as (w == 0) for all normalizations below
+    w_nonzeros = (~w_zeros).astype(lap.dtype)
+    # the csr structure of lap does not change, the normalizations below
+    # scale lap.data in place; rows[k] is the row of lap.data[k]
+    rows = np.repeat(np.arange(n_nodes, dtype=lap.indices.dtype), np.diff(lap.indptr))
+    diag_positions, diag_rows = _csr_diag_positions(lap, rows)
     if normed == 'symmetricnormalized':
         w = np.sqrt(degrees)
-        w_zeros = (w == 0)
         w[w_zeros] = 1
-        lap.data /= w[lap.row]
-        lap.data /= w[lap.col]
-        lap.data[diag_mask] -= 1. 
-
-    if normed == 'geometric':
-        w = degrees.copy()     # normzlize one symmetrically by d
-        w_zeros = (w == 0)
-        w[w_zeros] = 1
-        lap.data /= w[lap.row]
-        lap.data /= w[lap.col]
-        w = np.asarray(lap.sum(axis=1)).squeeze() #normalize again asymmetricall
-        if return_lapsym:
-            lapsym = lap.copy()
-        lap.data /= w[lap.row]
-        lap.data[diag_mask] -= 1.
+        inv_w = 1./w
+        lap.data *= inv_w[rows] * inv_w[lap.indices]
+        _subtract_diag_csr(lap, w_nonzeros, diag_positions, diag_rows)
 
-    if normed == 'renormalized':
-        w = degrees**renormalization_exponent;
-        # same as 'geoetric' from here on
-        w_zeros = (w == 0)
+    if normed in ('geometric', 'renormalized'):
+        if normed == 'geometric':
+            w = degrees.copy()     # normalize once symmetrically by d
+        else:
+            w = degrees**renormalization_exponent;
+        # same for 'geometric' and 'renormalized' from here on
         w[w_zeros] = 1
-        lap.data /= w[lap.row]
-        lap.data /= w[lap.col]
-        w = np.asarray(lap.sum(axis=1)).squeeze() #normalize again asymmetricall
+        inv_w = 1./w
+        # row sums of the symmetrically normalized matrix, without forming it
+        w = inv_w * lap.dot(inv_w) #normalize again asymmetricall
+        inv_w2 = 1./np.where(w == 0, 1., w)
         if return_lapsym:
+            lap.data *= inv_w[rows] * inv_w[lap.indices]
             lapsym = lap.copy()
-        lap.data /= w[lap.row]
-        lap.data[diag_mask] -= 1.
+            lap.data *= inv_w2[rows]
+        else:
+            # both normalizations in one pass
+            lap.data *= (inv_w * inv_w2)[rows] * inv_w[lap.indices]
+        _subtract_diag_csr(lap, w_nonzeros, diag_positions, diag_rows)
 
     if normed == 'unnormalized':
-        lap.data[diag_mask] -= degrees
+        _subtract_diag_csr(lap, degrees, diag_positions, diag_rows)
     if normed == 'randomwalk':
-        lap.data /= degrees[lap.row]
-        lap.data[diag_mask] -= 1.
+        lap.data *= (1./np.where(w_zeros, 1., degrees))[rows]
+        _subtract_diag_csr(lap, np.ones(n_nodes, dtype=lap.dtype), diag_positions, diag_rows)
     if scaling_epps > 0.:
         lap.data *= 4/(scaling_epps**2)
 
     if return_diag:
         if return_lapsym:
-            return lap, lap.data[diag_mask], lapsym, w
+            return lap, lap.diagonal(), lapsym, w
         else: 
-            return lap, lap.data[diag_mask]
+            return lap, lap.diagonal()
     elif return_lapsym:
         return lap, lapsym, w
     else:
         return lap
 
+def _csr_diag_positions(A, rows):
+    """ Positions in A.data of the stored diagonal entries of the csr matrix
+    A, and the rows of these entries; rows[k] is the row of A.data[k]. A
+    diagonal entry stored more than once is returned only once.
+    """
+    positions = np.flatnonzero(rows == A.indices)
+    diag_rows = rows[positions]
+    if np.any(np.diff(diag_rows) == 0):   # duplicates, diag_rows is sorted
+        diag_rows, first = np.unique(diag_rows, return_index=True)
+        positions = positions[first]
+    return positions, diag_rows
+
+def _subtract_diag_csr(A, values, positions, diag_rows):
+    """ A[i, i] -= values[i], in place, for the csr matrix A, with the
+    diagonal entries of A found by _csr_diag_positions
+    """
+    if diag_rows.shape[0] < A.shape[0]:
+        missing = np.ones(A.shape[0], dtype=bool)
+        missing[diag_rows] = False
+        if np.any(values[missing] != 0):
+            A.setdiag(A.diagonal() - values)    # inserts the missing diagonal entries
+            return
+    A.data[positions] -= values[diag_rows]
+
+def _row_sum_csr(A):
+    """ Row sums of the csr matrix A, by a single reduction over A.data
+    (A.sum(axis=1) does a matrix-vector product with a vector of ones)
+    """
+    sums = np.zeros(A.shape[0], dtype=A.dtype)
+    nonempty = (np.diff(A.indptr) > 0)    # reduceat would repeat a value for empty rows
+    if A.nnz > 0:
+        sums[nonempty] = np.add.reduceat(A.data, A.indptr[:-1][nonempty])
+    return sums
+
 def _laplacian_dense(csgraph, normed='geometric', symmetrize=True, scaling_epps=0., renormalization_exponent=1, return_diag=False, return_lapsym = False):
     n_nodes = csgraph.shape[0]
     if symmetrize:
-        lap = (csgraph + csgraph.T)/2.
+        lap = np.empty_like(csgraph)
+        np.add(csgraph, csgraph.T, out=lap)     # csgraph.T is a view, not a copy
+        lap *= 0.5
     else:
         lap = csgraph.copy()
     degrees = np.asarray(lap.sum(axis=1)).squeeze()
     di = np.diag_indices( lap.shape[0] )  # diagonal indices
+    w_zeros = (degrees == 0)      # same as (w == 0) for all normalizations below
+    w_nonzeros = (~w_zeros).astype(lap.dtype)
 
     if normed == 'symmetricnormalized':
         w = np.sqrt(degrees)
-        w_zeros = (w == 0)
-        w[w_zeros] = 1
-        lap /= w
-        lap /= w[:, np.newaxis]
-        di = np.diag_indices( lap.shape[0] )
-        lap[di] -= (1 - w_zeros).astype(lap.dtype)
-    if normed == 'geometric':
-        w = degrees.copy()     # normalize once symmetrically by d
-        w_zeros = (w == 0)
         w[w_zeros] = 1
-        lap /= w
-        lap /= w[:, np.newaxis]
-        w = np.asarray(lap.sum(axis=1)).squeeze() #normalize again asymmetricall
-        if return_lapsym:
-            lapsym = lap.copy()
-        lap /= w[:, np.newaxis]
-        lap[di] -= (1 - w_zeros).astype(lap.dtype)
-    if normed == 'renormalized':
-        w = degrees**renormalization_exponent;
-        # same as 'geometric' from here on
-        w_zeros = (w == 0)
+        inv_w = 1./w
+        np.multiply(lap, inv_w[:, np.newaxis], out=lap)   # not *=, a matrix product for np.matrix
+        np.multiply(lap, inv_w, out=lap)
+        lap[di] -= w_nonzeros
+    if normed in ('geometric', 'renormalized'):
+        if normed == 'geometric':
+            w = degrees.copy()     # normalize once symmetrically by d
+        else:
+            w = degrees**renormalization_exponent;
+        # same for 'geometric' and 'renormalized' from here on
         w[w_zeros] = 1
-        lap /= w
-        lap /= w[:, np.newaxis]
-        w = np.asarray(lap.sum(axis=1)).squeeze() #normalize again asymmetricall
+        inv_w = 1./w
         if return_lapsym:
+            np.multiply(lap, inv_w[:, np.newaxis], out=lap)
+            np.multiply(lap, inv_w, out=lap)
+            w = np.asarray(lap.sum(axis=1)).squeeze() #normalize again asymmetricall
             lapsym = lap.copy()
-        lap /= w[:, np.newaxis]
-        lap[di] -= (1 - w_zeros).astype(lap.dtype)
+            np.multiply(lap, (1./np.where(w == 0, 1., w))[:, np.newaxis], out=lap)
+        else:
+            # row sums of the symmetrically normalized matrix, without forming it
+            w = inv_w * np.asarray(lap.dot(inv_w)).ravel() #normalize again asymmetricall
+            np.multiply(lap, (inv_w / np.where(w == 0, 1., w))[:, np.newaxis], out=lap)
+            np.multiply(lap, inv_w, out=lap)
+        lap[di] -= w_nonzeros
     if normed == 'unnormalized':
         dum = lap[di]-degrees[np.newaxis,:]
         lap[di] = dum[0,:]
     if normed == 'randomwalk':
         lap /= degrees[:,np.newaxis]
-        lap -= np.eye(lap.shape[0])
+        lap[di] -= 1.       # no N x N identity needed
 
     if scaling_epps > 0.:
         lap *= 4/(scaling_epps**2)
@@ -332,7 +520,7 @@ def _laplacian_dense(csgraph, normed='geometric', symmetrize=True, scaling_epps=
         return lap
 
 def distance_matrix( X, flindex = None, mode='radius_neighbors', 
-                     neighbors_radius=None, symmetrize = True, n_neighbors=0 ):
+                     neighbors_radius=None, symmetrize = True, n_neighbors=0, dtype=None ):
     # DNearest neighbors has issues. TB FIXED
     if mode == 'nearest_neighbors':
         warnings.warn("Nearest neighbors currently does not work"
@@ -343,15 +531,18 @@ def distance_matrix( X, flindex = None, mode='radius_neighbors',
         neighbors_radius_ = (neighbors_radius
                              if neighbors_radius is not None else 1.0 / X.shape[1])   # to put another defaault value, like diam(X)/sqrt(dimensions)/10
         if flindex is not None:
-            distance_matrix = fl_radius_neighbors_graph(X, neighbors_radius_, flindex, mode='distance')
+            distance_matrix = _csr_from_triple(fl_radius_neighbors_graph(X, neighbors_radius_, flindex, mode='distance', dtype=dtype))
+            distance_matrix.has_canonical_format = True
         else:
             distance_matrix = radius_neighbors_graph(X, neighbors_radius_, mode='distance')
+            if dtype is not None:
+                distance_matrix = distance_matrix.astype(dtype, copy=False)
         return distance_matrix
 
-def fl_radius_neighbors_graph( X, radius, flindex, mode = 'distance'):
+def fl_radius_neighbors_graph( X, radius, flindex, mode = 'distance', n_jobs = None, dtype = None ):
     """
-    Constructs a sparse distance matrix called graph in coo
-    format. 
+    Constructs a sparse distance matrix called graph, and returns
+    the arrays of its csr representation. 
     Parameters
     ----------
     X: data matrix, array_like, shape = (n_samples, n_dimensions )
@@ -369,10 +560,22 @@ def fl_radius_neighbors_graph( X, radius, flindex, mode = 'distance'):
        "distance": graph contains pairwise distances
        "adjacency": grah contains 0. or 1., i.e it is an adjacency matrix
 
+    n_jobs: int, optional
+       number of threads querying flindex one point at a time, when
+       flindex cannot answer all queries in one call. FLANN releases the
+       GIL during a query, so threads run in parallel. Default is
+       os.cpu_count(); use n_jobs = 1 for a serial loop.
+
+    dtype: numpy floating type, optional
+       type of the distances stored in graph, e.g. np.float32. Default:
+       the type returned by flindex
+
     Returns
     -------
-    graph: the distance matrix, array_like, shape = (X.shape[0],X.shape[0])
-           sparse coo or csr format
+    (indptr, indices, data): the distance matrix, shape = (X.shape[0],X.shape[0]),
+           as the arrays of its csr representation, in canonical format.
+           sparse.csr_matrix((data, indices, indptr)) makes the matrix
+           without copying them. See also fl_radius_neighbors_graph_coo
     
    Notes
    -----
@@ -385,20 +588,72 @@ def fl_radius_neighbors_graph( X, radius, flindex, mode = 'distance'):
         raise ValueError('neighbors_radius must be >=0.')
     nsam, ndim = X.shape
     
-    graph_jindices = []
-    graph_iindices = []
-    graph_data = []
-    for i in range( nsam ):
-        jj, dd = flindex.nn_radius( X[i,:], radius )
-        graph_data.append( dd )
-        graph_jindices.append( jj )
-        graph_iindices.append( i*np.ones( jj.shape, dtype=int ))
+    batch = _fl_nn_radius_batch( flindex, X, radius )
+    if batch is not None:
+        graph_jindices, graph_data = batch
+    else:
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
 
+        def _query( i ):
+            return flindex.nn_radius( X[i,:], radius )
+
+        if n_jobs > 1 and nsam > 1:
+            with ThreadPoolExecutor( max_workers=n_jobs ) as executor:
+                results = list( executor.map( _query, range( nsam )))
+        else:
+            results = [ _query( i ) for i in range( nsam )]
+        graph_jindices = [ jj for jj, dd in results ]
+        graph_data = [ dd for jj, dd in results ]
+
+    counts = np.array([ jj.shape[0] for jj in graph_jindices ], dtype=np.int64 )   # number of neighbors of each row
     graph_data = np.concatenate( graph_data )
-    graph_iindices = np.concatenate( graph_iindices )
+    if dtype is not None:
+        graph_data = graph_data.astype( dtype, copy=False )
     graph_jindices = np.concatenate( graph_jindices )
-    graph = sparse.coo_matrix((graph_data, (graph_iindices, graph_jindices)), shape=(nsam, nsam))
-    return graph
+    graph_indptr = np.concatenate(( [0], np.cumsum( counts )))
+    # the rows come out of FLANN in order and without duplicate neighbors,
+    # so the csr matrix is built directly, with no coo sort and sum_duplicates
+    graph = sparse.csr_matrix((graph_data, graph_jindices, graph_indptr), shape=(nsam, nsam))
+    graph.sort_indices()        # only the neighbors within each row are unsorted
+    return graph.indptr, graph.indices, graph.data
+
+def fl_radius_neighbors_graph_coo( X, radius, flindex, mode = 'distance', n_jobs = None, dtype = None ):
+    """
+    Same as fl_radius_neighbors_graph, but returns graph as a sparse
+    matrix in coo format
+    """
+    graph = fl_radius_neighbors_graph( X, radius, flindex, mode=mode, n_jobs=n_jobs, dtype=dtype )
+    return _csr_from_triple( graph ).tocoo()
+
+def _csr_from_triple( graph ):
+    """ csr matrix of shape (N, N) sharing the arrays of the triple
+    graph = (indptr, indices, data)
+    """
+    indptr, indices, data = graph
+    n = indptr.shape[0] - 1
+    return sparse.csr_matrix(( data, indices, indptr ), shape=(n, n))
+
+_fl_batch_support = {}   # type of flindex -> whether nn_radius accepts a matrix of queries
+
+def _fl_nn_radius_batch( flindex, X, radius ):
+    """
+    Radius queries for all rows of X in a single call to flindex.nn_radius,
+    for FLANN builds that accept a matrix of query points and return one
+    array of neighbors (and of distances) per query. Such a build says so
+    with a true class attribute nn_radius_accepts_matrix; the stock pyflann
+    supports single point queries only.
+
+    Returns (jj_list, dd_list), or None if flindex only supports single
+    point queries.
+    """
+    index_type = type( flindex )
+    if index_type not in _fl_batch_support:
+        _fl_batch_support[index_type] = bool( getattr( index_type, 'nn_radius_accepts_matrix', False ))
+    if not _fl_batch_support[index_type]:
+        return None
+    jj_list, dd_list = flindex.nn_radius( X, radius )
+    return list( jj_list ), list( dd_list )
 
 class DistanceMatrix:
 
@@ -441,21 +696,21 @@ class DistanceMatrix:
         else:
             return self.distance_matrix
 
-"""
-Symmetrizes a sparse matrix in place (coo and csr formats only)
-
-NOTES: 
-  1) if there are values of 0 or 0.0 in the sparse matrix, this operation will DELETE them. 
-  2) currently, if the matrix is in coo format, the symmetrization converts
-  automatically to csr. I did not find it necessary to revert to coo, as 
-  the plan is to migrate away from coo in the near future.
-  3 ) currently convert to coo; how to circumvent?
-"""
-
 def symmetrize_sparse( A ):
-    if A.getformat() is not "coo":
-        A = A.tocoo()
-    A = (A + A.transpose(copy = True))/2.
+    """
+    Returns (A + A.T)/2 as a csr matrix in canonical format (sorted
+    indices, no duplicates)
+
+    NOTES: 
+      1) if there are values of 0 or 0.0 in the sparse matrix, this operation will DELETE them. 
+      2) the matrix is converted to csr, whatever its input format; the
+      sum is done entirely in csr, so no coo to csr conversion happens
+    """
+    A = A.tocsr()
+    A = A + A.T.tocsr()
+    A.data *= 0.5
+    A.sum_duplicates()      # sorts indices if needed and sets has_canonical_format
+    return A
 
 # not used
 def symmetrize_sparse_coo( A ):
@@ -467,22 +722,73 @@ def symmetrize_sparse_coo( A ):
     At.col = dum
     A = A + At
 
-def affinity_matrix( distances, neighbors_radius, symmetrize = True ):
+def _make_gaussian_kernel_numba( numba ):
+    """ Compiles _gaussian_kernel_numba, see _numba_kernel """
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _gaussian_kernel_numba( d, inv_r2_neg ):
+        """ exp(d**2 * inv_r2_neg) elementwise for the 1D array d, in one
+        multithreaded pass
+        """
+        out = np.empty_like( d )
+        for i in numba.prange( d.shape[0] ):
+            out[i] = math.exp( d[i]*d[i]*inv_r2_neg )
+        return out
+    return _gaussian_kernel_numba
+
+# Single threaded, numexpr and numba evaluate exp(d*d*c) 2-3 times slower
+# than numpy, whose exp is vectorized (see benchmarks/bench_gaussian_kernel.py).
+# They are used only with enough threads, on arrays large enough to pay for
+# starting them.
+_KERNEL_MIN_THREADS = 4
+_KERNEL_MIN_SIZE = 1000000
+
+def _gaussian_kernel_numpy( d, inv_r2_neg ):
+    """ exp(d**2 * inv_r2_neg) elementwise, computed in one new array """
+    A = np.multiply( d, d )
+    A *= inv_r2_neg
+    np.exp( A, out=A )
+    return A
+
+def _gaussian_kernel( d, neighbors_radius ):
+    """ Returns exp(-d**2/neighbors_radius**2), elementwise, as a new array,
+    for a floating array d.
+    """
+    # the constant has the type of d, so float32 stays float32
+    inv_r2_neg = np.asarray( -1./neighbors_radius**2, dtype=d.dtype )
+    if d.size >= _KERNEL_MIN_SIZE:
+        if d.dtype in ( np.float32, np.float64 ):
+            gaussian_kernel_numba = _numba_kernel( _make_gaussian_kernel_numba )
+            if gaussian_kernel_numba is not None and _import_optional( 'numba' ).get_num_threads() >= _KERNEL_MIN_THREADS:
+                return gaussian_kernel_numba( d.ravel(), inv_r2_neg[()] ).reshape( d.shape )
+        numexpr = _import_optional( 'numexpr' )
+        if numexpr is not None and numexpr.get_num_threads() >= _KERNEL_MIN_THREADS:
+            return numexpr.evaluate( 'exp(d*d*c)', local_dict={ 'd': d, 'c': inv_r2_neg })
+    return _gaussian_kernel_numpy( d, inv_r2_neg )
+
+def affinity_matrix( distances, neighbors_radius, symmetrize = True, dtype = None ):
+    """ distances: dense or sparse matrix, or csr triple (indptr, indices, data)
+    as returned by fl_radius_neighbors_graph
+    dtype: numpy floating type of the affinities, e.g. np.float32.
+    Default: the type of distances (np.float64 for integer distances)
+    """
     if neighbors_radius <= 0.:
         raise ValueError('neighbors_radius must be >0.')
-    A = distances.copy()
-    if sparse.isspmatrix( A ):
-        A.data = A.data**2
-        A.data = A.data/(-neighbors_radius**2)
-        np.exp( A.data, A.data )
+    if isinstance( distances, tuple ):
+        distances = _csr_from_triple( distances )
+    if dtype is None and not np.issubdtype( distances.dtype, np.floating ):
+        dtype = np.float64
+    if sparse.isspmatrix( distances ):
+        distances = distances.tocsr()   # no copy if already csr
+        if dtype is not None:
+            distances = distances.astype( dtype, copy=False )
         if symmetrize:
-            symmetrize_sparse( A )  # converts to CSR; deletes 0's
+            # A is only a temporary here, it can share indices with distances
+            A = sparse.csr_matrix(( _gaussian_kernel( distances.data, neighbors_radius ), distances.indices, distances.indptr ), shape=distances.shape )
+            A = symmetrize_sparse( A )  # converts to CSR; deletes 0's
         else:
-            pass
+            A = sparse.csr_matrix(( _gaussian_kernel( distances.data, neighbors_radius ), distances.indices.copy(), distances.indptr.copy() ), shape=distances.shape )
     else:
-        A **= 2
-        A /= (-neighbors_radius**2)
-        np.exp(A, A)
+        A = _gaussian_kernel( np.asarray( distances, dtype=dtype ), neighbors_radius )
         if symmetrize:
             A = (A+A.T)/2
             A = np.asarray( A, order="C" )  # is this necessary??
@@ -18,46 +18,14 @@ from sklearn.externals import six
 from sklearn.utils import check_random_state
 from sklearn.utils.validation import atleast2d_or_csr
 from sklearn.utils.graph import graph_laplacian
-from sklearn.utils.sparsetools import connected_components
 from sklearn.utils.arpack import eigsh
 from sklearn.metrics.pairwise import rbf_kernel
 from sklearn.neighbors import radius_neighbors_graph
 from sklearn.neighbors import kneighbors_graph
+from .geometry import connected_components
 timing = False
 
 
-def _graph_connected_component(graph, node_id):
-    """Find the largest graph connected components the contains one
-    given node
-
-    Parameters
-    ----------
-    graph : array-like, shape: (n_samples, n_samples)
-        adjacency matrix of the graph, non-zero weight means an edge
-        between the nodes
-
-    node_id : int
-        The index of the query node of the graph
-
-    Returns
-    -------
-    connected_components : array-like, shape: (n_samples,)
-        An array of bool value indicates the indexes of the nodes
-        belong to the largest connected components of the given query
-        node
-    """
-    connected_components = np.zeros(shape=(graph.shape[0]), dtype=np.bool)
-    connected_components[node_id] = True
-    n_node = graph.shape[0]
-    for i in range(n_node):
-        last_num_component = connected_components.sum()
-        _, node_to_add = np.where(graph[connected_components] != 0)
-        connected_components[node_to_add] = True
-        if last_num_component >= connected_components.sum():
-            break
-    return connected_components
-
-
 def _graph_is_connected(graph):
     """ Return whether the graph is connected (True) or Not (False)
 
@@ -72,13 +40,9 @@ def _graph_is_connected(graph):
     is_connected : bool
         True means the graph is fully connected and False means not
     """
-    if sparse.isspmatrix(graph):
-        # sparse graph, find all the connected components
-        n_connected_components, _ = connected_components(graph)
-        return n_connected_components == 1
-    else:
-        # dense graph, find all connected components start from node 0
-        return _graph_connected_component(graph, 0).sum() == graph.shape[0]
+    # sparse or dense graph, find all the connected components
+    n_connected_components, _ = connected_components(graph)
+    return n_connected_components == 1
 
 
 def _set_diag(laplacian, value):
@@ -5,12 +5,13 @@ from scipy.sparse import csr_matrix
 from scipy.sparse import csc_matrix
 from scipy.sparse import isspmatrix
 import numpy as np
-from numpy.testing import assert_array_almost_equal, assert_array_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal, assert_allclose
 
 from nose.tools import assert_raises
 from nose.plugins.skip import SkipTest
 
 from ..embedding.geometry import *
+from ..embedding import geometry
 from ..embedding.spectral_embedding_ import _graph_is_connected
 
 def _load_test_data():
@@ -86,8 +87,7 @@ def test_equal_original(almost_equal_decimals = 5):
             if issparse:
                 print( 'sparse ', normed )
                 assert_array_almost_equal( L.toarray(), Ltest, 5 )
-                diag_mask = (L.row == L.col )
-                assert_array_equal(diag, L.data[diag_mask].squeeze())
+                assert_array_equal(diag, L.diagonal())
             else:
                 print( 'dense ', normed )
                 assert_array_almost_equal( L, Ltest, 5 )
@@ -97,3 +97,215 @@ def test_equal_original(almost_equal_decimals = 5):
 #TODO: test symmetry 
 # test radius
 # test with flann
+
+def test_single_source_shortest_path_length():
+    """ BFS path lengths on a path graph, with and without cutoff, dense and
+    sparse input
+    """
+    graph = np.array([[ 0, 1, 0, 0 ],
+                      [ 1, 0, 1, 0 ],
+                      [ 0, 1, 0, 1 ],
+                      [ 0, 0, 1, 0 ]])
+    for G in [graph, csr_matrix(graph), sparse.coo_matrix(graph)]:
+        assert_equal(single_source_shortest_path_length(G, 0), {0: 0, 1: 1, 2: 2, 3: 3})
+        assert_equal(single_source_shortest_path_length(G, 1, cutoff=1), {0: 1, 1: 0, 2: 1})
+        assert_equal(single_source_shortest_path_length(G, 3, cutoff=0), {3: 0})
+        assert_array_equal(single_source_shortest_path_length(G, 0, cutoff=2, return_array=True), [0., 1., 2., np.inf])
+    assert_equal(single_source_shortest_path_length(np.ones((6, 6)), 2), {0: 1, 1: 1, 2: 0, 3: 1, 4: 1, 5: 1})
+    for source in [4, 1000000, -1]:
+        assert_raises(ValueError, single_source_shortest_path_length, graph, source)
+    dist = multi_source_shortest_path_length(graph, [0, 3], cutoff=2)
+    assert_array_equal(dist, [[0., 1., 2., np.inf], [np.inf, 2., 1., 0.]])
+
+def test_symmetrize_sparse():
+    """ symmetrize_sparse returns (A + A.T)/2 in canonical csr format """
+    A = np.array([[ 1., 2., 0. ], [ 0., 3., 4. ], [ 1., 0., 5. ]])
+    for A_sparse in [ csr_matrix( A ), sparse.coo_matrix( A ) ]:
+        S = symmetrize_sparse( A_sparse )
+        assert_equal( S.format, 'csr' )
+        assert_true( S.has_canonical_format )
+        assert_array_almost_equal( S.toarray(), (A + A.T)/2. )
+
+def test_connected_components():
+    """ connected_components labels the components of dense and sparse graphs """
+    graph = np.zeros((6, 6))
+    graph[0, 1] = graph[1, 0] = 1.
+    graph[2, 3] = 1.        # directed edge, the component is weakly connected
+    graph[4, 5] = graph[5, 4] = 1.
+    for G in [graph, csr_matrix(graph), csc_matrix(graph)]:
+        n_components, labels = connected_components(G)
+        assert_equal(n_components, 3)
+        assert_array_equal(labels, [0, 0, 1, 1, 2, 2])
+
+def test_laplacian_sparse_missing_diagonal():
+    """ Sparse laplacians of a graph with no stored diagonal entries (the 
+    diagonal has to be inserted) are the same as the dense ones
+    """
+    A = np.array([[ 0., 1., 0., 2. ], [ 1., 0., 3., 0. ], [ 0., 3., 0., 1. ], [ 2., 0., 1., 0. ]])
+    for normed in ['symmetricnormalized', 'unnormalized', 'geometric', 'randomwalk', 'renormalized']:
+        L_dense, diag_dense = graph_laplacian( A, normed=normed, return_diag=True )
+        L_sparse, diag_sparse = graph_laplacian( csr_matrix( A ), normed=normed, return_diag=True )
+        assert_array_almost_equal( L_sparse.toarray(), L_dense )
+        assert_array_almost_equal( diag_sparse, diag_dense )
+
+def test_laplacian_dense_matrix_input():
+    """ np.matrix input gives the same laplacian as np.ndarray input """
+    A = np.array([[ 5., 2., 1. ], [ 2., 3., 2. ], [ 1., 2., 5. ]])
+    for normed in ['symmetricnormalized', 'unnormalized', 'geometric', 'randomwalk', 'renormalized']:
+        L = graph_laplacian( A, normed=normed )
+        L_matrix = graph_laplacian( np.asmatrix( A ), normed=normed )
+        assert_array_almost_equal( np.asarray( L_matrix ), L )
+
+class _FakeFlann:
+    """ Radius queries answered exactly, one point at a time as by the
+    stock pyflann, with the neighbors of each point in reverse order
+    """
+    def __init__(self, X):
+        self.X = X
+        self.calls = 0
+
+    def nn_radius(self, q, r):
+        assert_equal(q.ndim, 1)
+        d = np.sqrt(((self.X - q)**2).sum(axis=1))
+        jj = np.flatnonzero(d <= r)[::-1].astype(np.int32)
+        return jj, d[jj]
+
+class _FakeFlannBatch(_FakeFlann):
+    """ Same as _FakeFlann, but answers all the queries in one call """
+    nn_radius_accepts_matrix = True
+
+    def nn_radius(self, q, r):
+        self.calls += 1
+        results = [_FakeFlann.nn_radius(self, q_i, r) for q_i in q]
+        return [jj for jj, dd in results], [dd for jj, dd in results]
+
+def test_fl_radius_neighbors_graph_batch():
+    """ A flindex answering matrix queries is called once, and gives the
+    same triple as the point by point queries
+    """
+    rng = np.random.RandomState(0)
+    for X in [rng.rand(50, 3), rng.rand(3, 3)]:
+        flindex = _FakeFlannBatch(X)
+        batch = fl_radius_neighbors_graph(X, 0.4, flindex)
+        assert_equal(flindex.calls, 1)
+        for array_batch, array in zip(batch, fl_radius_neighbors_graph(X, 0.4, _FakeFlann(X), n_jobs=1)):
+            assert_array_equal(array_batch, array)
+
+def test_fl_radius_neighbors_graph():
+    """ The csr triple from fl_radius_neighbors_graph is the same, threaded
+    or not, as the coo graph, and works as input of affinity_matrix and
+    graph_laplacian
+    """
+    rng = np.random.RandomState(0)
+    X = rng.rand(50, 3)
+    radius = 0.4
+    flindex = _FakeFlann(X)
+    dist = np.sqrt(((X[:, np.newaxis, :] - X[np.newaxis, :, :])**2).sum(axis=2))
+    for n_jobs in [1, 4]:
+        indptr, indices, data = fl_radius_neighbors_graph(X, radius, flindex, n_jobs=n_jobs)
+        G = csr_matrix((data, indices, indptr), shape=(50, 50))
+        assert_true(G.has_canonical_format)
+        assert_array_almost_equal(G.toarray(), np.where(dist <= radius, dist, 0.))
+        G_coo = fl_radius_neighbors_graph_coo(X, radius, flindex, n_jobs=n_jobs)
+        assert_equal(G_coo.format, 'coo')
+        assert_array_equal(G_coo.toarray(), G.toarray())
+        triple = (indptr, indices, data)
+        assert_array_almost_equal(affinity_matrix(triple, radius).toarray(),
+                                  affinity_matrix(G, radius).toarray())
+        assert_array_almost_equal(graph_laplacian(triple, normed='geometric').toarray(),
+                                  graph_laplacian(G, normed='geometric').toarray())
+    D = distance_matrix(X, flindex, neighbors_radius=radius)
+    assert_equal(D.format, 'csr')
+    assert_true(D.has_canonical_format)
+    assert_array_equal(D.toarray(), G.toarray())
+
+def test_graph_laplacian_batch():
+    """ graph_laplacian_batch gives the graph_laplacian of each graph, in order """
+    rng = np.random.RandomState(0)
+    graphs = []
+    for n in [5, 8, 6]:
+        A = rng.rand(n, n)
+        A[A < 0.5] = 0.
+        graphs.extend([A, csr_matrix(A)])
+    for kwargs in [dict(normed='geometric'), 
+                   dict(normed='renormalized', symmetrize=True, return_diag=True),
+                   dict(normed='symmetricnormalized', return_diag=True)]:
+        results = graph_laplacian_batch(graphs, n_jobs=2, **kwargs)
+        expected = [graph_laplacian(G, **kwargs) for G in graphs]
+        assert_equal(len(results), len(expected))
+        for result, expect in zip(results, expected):
+            if kwargs.get('return_diag'):
+                (L, diag), (L_expect, diag_expect) = result, expect
+                assert_array_almost_equal(diag, diag_expect)
+            else:
+                L, L_expect = result, expect
+            assert_equal(isspmatrix(L), isspmatrix(L_expect))
+            if isspmatrix(L):
+                L, L_expect = L.toarray(), L_expect.toarray()
+            assert_array_almost_equal(L, L_expect)
+
+def test_float32():
+    """ With dtype=np.float32 the affinities and laplacians (sparse and
+    dense) stay float32, and match the float64 ones to about 1e-5
+    """
+    rad, test_dist_matrix, A, Lsymnorm, Lunnorm, Lgeom, Lreno1_5, Lrw = _load_test_data()
+    rad = rad[0][0]
+    for distances in [test_dist_matrix, csr_matrix(test_dist_matrix)]:
+        A32 = affinity_matrix(distances, rad, dtype=np.float32)
+        A64 = affinity_matrix(distances, rad)
+        assert_equal(A32.dtype, np.float32)
+        for normed in ['symmetricnormalized', 'unnormalized', 'geometric', 'randomwalk', 'renormalized']:
+            return_lapsym = normed in ['geometric', 'renormalized']
+            results32 = graph_laplacian(A32, normed=normed, scaling_epps=rad, return_diag=True, return_lapsym=return_lapsym)
+            results64 = graph_laplacian(A64, normed=normed, scaling_epps=rad, return_diag=True, return_lapsym=return_lapsym)
+            for result32, result64 in zip(results32, results64):
+                assert_equal(result32.dtype, np.float32)
+                if isspmatrix(result32):
+                    result32, result64 = result32.toarray(), result64.toarray()
+                assert_true(np.abs(result32 - result64).max() <= 1e-5 * np.abs(result64).max())
+    distances = np.array([[ 0, 1 ], [ 1, 0 ]])
+    for distances in [distances, csr_matrix(distances)]:
+        assert_equal(affinity_matrix(distances, 1.).dtype, np.float64)
+    X = np.random.RandomState(0).rand(50, 3)
+    D = distance_matrix(X, _FakeFlann(X), neighbors_radius=0.4, dtype=np.float32)
+    assert_equal(D.dtype, np.float32)
+    assert_array_almost_equal(D.toarray(), distance_matrix(X, _FakeFlann(X), neighbors_radius=0.4).toarray(), decimal=5)
+
+def _check_gaussian_kernel(disable_numba):
+    """ affinity_matrix with the size and thread thresholds of the
+    multithreaded kernels set to 0, so they are used on small inputs.
+    With disable_numba, the numba kernel is hidden and numexpr is used.
+    """
+    rng = np.random.RandomState(0)
+    radius = 0.5
+    saved = geometry._KERNEL_MIN_SIZE, geometry._KERNEL_MIN_THREADS, dict(geometry._numba_kernels)
+    geometry._KERNEL_MIN_SIZE = geometry._KERNEL_MIN_THREADS = 0
+    if disable_numba:
+        geometry._numba_kernels[geometry._make_gaussian_kernel_numba] = None
+    try:
+        for dtype in [np.float32, np.float64]:
+            d = rng.rand(20, 20).astype(dtype)
+            d[d < 0.5] = 0.
+            A = affinity_matrix(d, radius, symmetrize=False)
+            assert_equal(A.dtype, dtype)
+            assert_allclose(A, np.exp(-d**2/radius**2), rtol=1e-6)
+            d_sparse = csr_matrix(d)
+            A = affinity_matrix(d_sparse, radius, symmetrize=False)
+            assert_equal(A.dtype, dtype)
+            assert_allclose(A.data, np.exp(-d_sparse.data**2/radius**2), rtol=1e-6)
+    finally:
+        geometry._KERNEL_MIN_SIZE, geometry._KERNEL_MIN_THREADS, kernels = saved
+        geometry._numba_kernels.clear()
+        geometry._numba_kernels.update(kernels)
+
+def test_gaussian_kernel_numba():
+    """ The numba kernel (compiled with fastmath) is accurate and keeps the dtype """
+    if geometry._numba_kernel(geometry._make_gaussian_kernel_numba) is None:
+        raise SkipTest("numba not installed")
+    _check_gaussian_kernel(disable_numba=False)
+
+def test_gaussian_kernel_numexpr():
+    """ The numexpr kernel is accurate and keeps the dtype (no float32 upcast) """
+    if geometry._import_optional('numexpr') is None:
+        raise SkipTest("numexpr not installed")
+    _check_gaussian_kernel(disable_numba=True)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Benchmark of the kernels that compute the affinities exp(-d**2/r**2) in
+affinity_matrix, on arrays of distances of increasing size: numpy (three
+passes into one new array), numexpr and numba (one multithreaded pass).
+
+The thresholds _KERNEL_MIN_THREADS and _KERNEL_MIN_SIZE in geometry.py,
+above which numba or numexpr are used instead of numpy, come from this
+benchmark. Set NUMBA_NUM_THREADS and NUMEXPR_NUM_THREADS to compare
+different numbers of threads.
+"""
+import gc  #the garbage collector
+from time import time
+import numpy as np
+
+def best_time(kernel, d, inv_r2_neg, repeat = 5):
+    kernel(d, inv_r2_neg)       # warm up (and compile)
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        tstart = time()
+        kernel(d, inv_r2_neg)
+        times.append(time() - tstart)
+    return min(times)
+
+def compute_bench(sizes, dtype, kernels, quiet = False):
+    results = dict((name, []) for name in kernels)
+    for n in sizes:
+        d = np.random.random(n).astype(dtype)
+        inv_r2_neg = np.asarray(-1./0.5**2, dtype=dtype)
+        for name in kernels:
+            results[name].append(best_time(kernels[name], d, inv_r2_neg))
+        if not quiet:
+            print('%s n=%d ' % (np.dtype(dtype).name, n) +
+                  ' '.join('%s %.4fs' % (name, results[name][-1]) for name in kernels))
+    return results
+
+if __name__ == '__main__':
+    import sys
+    import os
+    path = os.path.abspath('..')
+    sys.path.append(path)
+    from Mmani.embedding.geometry import _gaussian_kernel_numpy, _import_optional, _numba_kernel, _make_gaussian_kernel_numba
+
+    kernels = { 'numpy': _gaussian_kernel_numpy }
+    numexpr = _import_optional('numexpr')
+    if numexpr is not None:
+        print('numexpr threads: %d' % numexpr.get_num_threads())
+        kernels['numexpr'] = lambda d, c: numexpr.evaluate('exp(d*d*c)', local_dict={'d': d, 'c': c})
+    gaussian_kernel_numba = _numba_kernel(_make_gaussian_kernel_numba)
+    if gaussian_kernel_numba is not None:
+        print('numba threads: %d' % _import_optional('numba').get_num_threads())
+        kernels['numba'] = lambda d, c: gaussian_kernel_numba(d, c[()])
+
+    list_sizes = np.logspace(4, 7, 7).astype(int)
+    for dtype in [np.float64, np.float32]:
+        compute_bench(list_sizes, dtype, kernels)